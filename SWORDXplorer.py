@@ -1,76 +1,347 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
 import pandas as pd
-import geopandas as gpd
-from io import StringIO
+import pyogrio
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from io import BytesIO
 import time
 import os
 import shutil
-import tempfile
 from datetime import datetime
 import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import deque
+import statistics
+import re
+import hashlib
+import diskcache
+
+# Upper bound for the parallel-requests slider; the HTTP pool is sized to match
+MAX_WORKERS = 32
+HYDROCRON_URL = "https://soto.podaac.earthdatacloud.nasa.gov/hydrocron/v1/timeseries"
+CACHE_DIR = os.path.expanduser("~/.sword_cache")
+CACHE_EXPIRE = 7 * 86400
+# Hydrocron CSV responses keyed by request URL, shared across sessions and restarts
+CACHE = diskcache.Cache(os.path.join(CACHE_DIR, "responses"))
+# Parquet copies of uploaded shapefiles, named by a hash of the upload
+SWORD_CACHE_DIR = os.path.join(CACHE_DIR, "sword")
+# Anything but letters, digits, space, underscore and hyphen is dropped from output names
+UNSAFE_PATH_CHARS = re.compile(r"[^\w -]")
 
 # --- Helper Functions ---
-def robust_rmtree(path):
-    for _ in range(3):
-        try:
-            shutil.rmtree(path)
-            return True
-        except Exception:
-            time.sleep(0.5)
-    return False
-
-
-def safe_temp_dir():
-    temp_dir = tempfile.mkdtemp(prefix="sword_temp_")
-    os.makedirs(temp_dir, exist_ok=True)
-    return temp_dir
-
-
-def get_valid_api_fields():
-    return [
-        "area_det_u", "area_detct", "area_total", "area_tot_u", "area_wse",
-        "collection_shortname", "collection_version", "continent_id", "crid", "cycle_id",
-        "dark_frac", "d_x_area", "d_x_area_u",
-        "dschg_b", "dschg_b_q", "dschg_bsf", "dschg_b_u",
-        "dschg_c", "dschg_c_q", "dschg_csf", "dschg_c_u",
-        "dschg_gb", "dschg_gb_q", "dschg_gbsf", "dschg_gb_u",
-        "dschg_gc", "dschg_gc_q", "dschg_gcsf", "dschg_gc_u",
-        "dschg_gh", "dschg_gh_q", "dschg_ghsf", "dschg_gh_u",
-        "dschg_gi", "dschg_gi_q", "dschg_gisf", "dschg_gi_u",
-        "dschg_gm", "dschg_gm_q", "dschg_gmsf", "dschg_gm_u",
-        "dschg_go", "dschg_go_q", "dschg_gosf", "dschg_go_u",
-        "dschg_gq_b", "dschg_s", "dschg_s_q", "dschg_ssf", "dschg_s_u",
-        "dschg_h", "dschg_h_q", "dschg_hsf", "dschg_h_u",
-        "dschg_i", "dschg_i_q", "dschg_isf", "dschg_i_u",
-        "dschg_m", "dschg_m_q", "dschg_msf", "dschg_m_u",
-        "dschg_o", "dschg_o_q", "dschg_osf", "dschg_o_u",
-        "dschg_q_b", "dry_trop_c", "geometry", "geoid_hght", "geoid_slop",
-        "granuleUR", "ice_clim_f", "ice_dyn_f", "ingest_time", "iono_c",
-        "layovr_val", "loc_offset", "load_tidef", "load_tideg", "n_good_nod",
-        "n_reach_dn", "n_reach_up", "node_dist", "obs_frac_n", "p_dam_id",
-        "p_dist_out", "p_lat", "p_length", "p_lon", "p_low_slp", "p_maf",
-        "p_n_ch_max", "p_n_ch_mod", "p_n_nodes", "p_wid_var", "p_width",
-        "p_wse", "p_wse_var", "partial_f", "pass_id", "pole_tide",
-        "range_end_time", "range_start_time", "reach_id", "reach_q", "reach_q_b",
-        "rch_id_dn", "rch_id_up", "river_name", "slope", "slope2", "slope2_r_u",
-        "slope2_u", "slope_r_u", "slope_u", "solid_tide", "sword_version",
-        "time", "time_str", "time_tai", "wse", "wse_c", "wse_c_u",
-        "wse_r_u", "wse_u", "width", "width_c", "width_c_u", "width_u",
-        "xovr_cal_c", "xovr_cal_q", "xtrk_dist"
-    ]
+def make_http_session():
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=MAX_WORKERS, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    # Hydrocron CSVs compress well; only advertise the codings urllib3 can decode here
+    # (br is listed only when the brotli package is installed)
+    session.headers.update({'Accept-Encoding': ACCEPT_ENCODING, 'Connection': 'keep-alive'})
+    return session
+
+
+VALID_API_FIELDS = (
+    "area_det_u", "area_detct", "area_total", "area_tot_u", "area_wse",
+    "collection_shortname", "collection_version", "continent_id", "crid", "cycle_id",
+    "dark_frac", "d_x_area", "d_x_area_u",
+    "dschg_b", "dschg_b_q", "dschg_bsf", "dschg_b_u",
+    "dschg_c", "dschg_c_q", "dschg_csf", "dschg_c_u",
+    "dschg_gb", "dschg_gb_q", "dschg_gbsf", "dschg_gb_u",
+    "dschg_gc", "dschg_gc_q", "dschg_gcsf", "dschg_gc_u",
+    "dschg_gh", "dschg_gh_q", "dschg_ghsf", "dschg_gh_u",
+    "dschg_gi", "dschg_gi_q", "dschg_gisf", "dschg_gi_u",
+    "dschg_gm", "dschg_gm_q", "dschg_gmsf", "dschg_gm_u",
+    "dschg_go", "dschg_go_q", "dschg_gosf", "dschg_go_u",
+    "dschg_gq_b", "dschg_s", "dschg_s_q", "dschg_ssf", "dschg_s_u",
+    "dschg_h", "dschg_h_q", "dschg_hsf", "dschg_h_u",
+    "dschg_i", "dschg_i_q", "dschg_isf", "dschg_i_u",
+    "dschg_m", "dschg_m_q", "dschg_msf", "dschg_m_u",
+    "dschg_o", "dschg_o_q", "dschg_osf", "dschg_o_u",
+    "dschg_q_b", "dry_trop_c", "geometry", "geoid_hght", "geoid_slop",
+    "granuleUR", "ice_clim_f", "ice_dyn_f", "ingest_time", "iono_c",
+    "layovr_val", "loc_offset", "load_tidef", "load_tideg", "n_good_nod",
+    "n_reach_dn", "n_reach_up", "node_dist", "obs_frac_n", "p_dam_id",
+    "p_dist_out", "p_lat", "p_length", "p_lon", "p_low_slp", "p_maf",
+    "p_n_ch_max", "p_n_ch_mod", "p_n_nodes", "p_wid_var", "p_width",
+    "p_wse", "p_wse_var", "partial_f", "pass_id", "pole_tide",
+    "range_end_time", "range_start_time", "reach_id", "reach_q", "reach_q_b",
+    "rch_id_dn", "rch_id_up", "river_name", "slope", "slope2", "slope2_r_u",
+    "slope2_u", "slope_r_u", "slope_u", "solid_tide", "sword_version",
+    "time", "time_str", "time_tai", "wse", "wse_c", "wse_c_u",
+    "wse_r_u", "wse_u", "width", "width_c", "width_c_u", "width_u",
+    "xovr_cal_c", "xovr_cal_q", "xtrk_dist"
+)
+DEFAULT_FIELDS = ("reach_id", "time_str", "wse", "width")
+
+
+@st.cache_data(show_spinner=False)
+def load_sword(files):
+    """Convert an uploaded shapefile's attribute table to Parquet and return the Parquet path."""
+    shp_name = next(name for name, _ in files if name.endswith('.shp'))
+    stem = os.path.splitext(shp_name)[0]
+    parts = [(name, data) for name, data in files if os.path.splitext(name)[0] == stem]
+
+    digest = hashlib.blake2b(digest_size=16)
+    for name, data in parts:
+        digest.update(name.encode())
+        digest.update(data)
+    cache_path = os.path.join(SWORD_CACHE_DIR, f"{digest.hexdigest()}-attrs.parquet")
+    if os.path.exists(cache_path):
+        return cache_path
+
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zipf:
+        for name, data in parts:
+            zipf.writestr(name, data)
+    buf.seek(0)
+    df = pyogrio.read_dataframe(buf, read_geometry=False)
+
+    os.makedirs(SWORD_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.tmp"
+    df.to_parquet(tmp_path, compression="zstd", index=False)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+# Shared rather than copied per call, like value_index; callers only read from it
+@st.cache_resource(show_spinner=False)
+def read_sword_columns(path, columns):
+    """Only the requested attribute columns of a converted SWORD upload."""
+    return pd.read_parquet(path, columns=list(columns))
+
+
+@st.cache_data(show_spinner=False)
+def distinct_values(path, column):
+    """Non-null distinct values of a column in first-seen order, computed once per upload."""
+    col = read_sword_columns(path, (column,))[column]
+    return pc.unique(pa.Array.from_pandas(col).drop_null()).to_pylist()
+
+
+# cache_resource hands back the same dict; cache_data would unpickle a copy on every call
+@st.cache_resource(show_spinner=False)
+def value_index(path, column):
+    """Row positions for every value of a column."""
+    return read_sword_columns(path, (column,)).groupby(column, sort=False).indices
+
+
+class BadRequest(Exception):
+    pass
+
+
+class NoData(Exception):
+    pass
+
+
+class RateLimiter:
+    """Token bucket with a single token: request starts are spaced `interval` seconds apart."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+class HedgedClient:
+    """Rate-limited GETs that race a duplicate request against stragglers."""
+
+    def __init__(self, session, limiter, max_workers, window=200, min_samples=20, budget=0.05):
+        self.session = session
+        self.limiter = limiter
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.budget = budget
+        self.requests = 0
+        self.hedges = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.lock = threading.Lock()
+        # Room for a primary and a hedge per fetch worker
+        self.pool = ThreadPoolExecutor(max_workers=2 * max_workers)
+
+    def _timed_get(self, url):
+        start = time.monotonic()
+        resp = self.session.get(url, timeout=(5, 30))
+        with self.lock:
+            self.latencies.append(time.monotonic() - start)
+        return resp
+
+    def _hedge_after(self):
+        with self.lock:
+            self.requests += 1
+            if len(self.latencies) < self.min_samples:
+                return None
+            return statistics.quantiles(self.latencies, n=20)[18]
+
+    def get(self, url):
+        resp = self._get(url)
+        # raw.tell() counts bytes as received, before any Content-Encoding is undone. It stays
+        # 0 for chunked responses, which are left out so the ratio covers like with like.
+        wire = resp.raw.tell() if resp.raw is not None else 0
+        if wire > 0:
+            with self.lock:
+                self.wire_bytes += wire
+                self.body_bytes += len(resp.content)
+        return resp
+
+    def _get(self, url):
+        self.limiter.wait()
+        delay = self._hedge_after()
+        primary = self.pool.submit(self._timed_get, url)
+        if delay is None or wait([primary], timeout=delay).done:
+            return primary.result()
+        with self.lock:
+            if self.hedges >= self.budget * self.requests:
+                hedge = False
+            else:
+                self.hedges += 1
+                hedge = True
+        if not hedge:
+            return primary.result()
+        self.limiter.wait()
+        if primary.done():
+            # The primary finished while we waited for a slot; the hedge is not needed
+            with self.lock:
+                self.hedges -= 1
+            return primary.result()
+        backup = self.pool.submit(self._timed_get, url)
+        done, _ = wait([primary, backup], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        if winner.exception() is not None:
+            # The loser may still succeed; requests cannot be cancelled mid-flight anyway
+            return (backup if winner is primary else primary).result()
+        return winner.result()
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_timeseries_csv(csv_txt):
+    """Parse a Hydrocron CSV payload, dropping rows whose time_str is not a timestamp."""
+    tbl = pacsv.read_csv(
+        BytesIO(csv_txt.encode()),
+        read_options=pacsv.ReadOptions(use_threads=False),
+        convert_options=pacsv.ConvertOptions(column_types={'time_str': pa.string()})
+    )
+    if 'time_str' in tbl.column_names:
+        # Hydrocron reports missing passes as "no_data"; those become null and are filtered out
+        times = pc.strptime(tbl['time_str'], format='%Y-%m-%dT%H:%M:%SZ', unit='ns', error_is_null=True)
+        tbl = tbl.set_column(
+            tbl.column_names.index('time_str'), 'time_str', times.cast(pa.timestamp('ns', tz='UTC'))
+        )
+        tbl = tbl.filter(pc.is_valid(tbl['time_str']))
+    return tbl
+
+
+def combine_tables(tables):
+    """Concatenate per-feature tables, widening columns whose inferred types differ."""
+    types = {}
+    for tbl in tables:
+        for field in tbl.schema:
+            if not pa.types.is_null(field.type):
+                types.setdefault(field.name, set()).add(field.type)
+    # Numeric and all-null mismatches are widened by the permissive concat; anything
+    # else (e.g. numbers in one payload, text in another) is kept as text
+    text_cols = {
+        name for name, found in types.items()
+        if len(found) > 1 and not all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in found)
+    }
+    if text_cols:
+        tables = [
+            tbl.cast(pa.schema([
+                pa.field(f.name, pa.string()) if f.name in text_cols else f for f in tbl.schema
+            ]))
+            for tbl in tables
+        ]
+    return pa.concat_tables(tables, promote_options="permissive")
+
+
+def fetch_feature(fid, url, client):
+    """Fetch one feature's time series; runs in a worker thread, so no Streamlit calls here."""
+    try:
+        key = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+        csv_txt = CACHE.get(key)
+        if csv_txt is None:
+            resp = client.get(url)
+            if resp.status_code == 400:
+                return fid, None, BadRequest(resp.text)
+            resp.raise_for_status()
+            data = resp.json()
+            csv_txt = data.get('results', {}).get('csv', '')
+            if not csv_txt:
+                return fid, None, NoData()
+            CACHE.set(key, csv_txt, expire=CACHE_EXPIRE)
+        return fid, parse_timeseries_csv(csv_txt), None
+    except Exception as e:
+        return fid, None, e
+
+
+def fetch_batch(fids, url_prefix, url_suffix, client, ids_key):
+    """Fetch several features with one comma-separated feature_id request."""
+    if len(fids) == 1:
+        return [fetch_feature(fids[0], url_prefix + fids[0] + url_suffix, client)]
+    joined = ','.join(fids)
+    _, tbl, err = fetch_feature(joined, url_prefix + joined + url_suffix, client)
+    if isinstance(err, BadRequest):
+        mid = len(fids) // 2
+        return (
+            fetch_batch(fids[:mid], url_prefix, url_suffix, client, ids_key)
+            + fetch_batch(fids[mid:], url_prefix, url_suffix, client, ids_key)
+        )
+    if err is not None:
+        return [(fid, None, err) for fid in fids]
+    try:
+        id_strs = tbl[ids_key].cast(pa.string())
+        results = []
+        for fid in fids:
+            part = tbl.filter(pc.equal(id_strs, fid))
+            results.append((fid, part, None) if part.num_rows else (fid, None, NoData()))
+        return results
+    except Exception as e:
+        return [(fid, None, e) for fid in fids]
 
 # --- App Config ---
 st.set_page_config(page_title="SWORDXplorer", layout="wide")
 st.title("SWOT Hydrocron API Data Download")
 
+# --- Sidebar ---
+if st.sidebar.button("Clear cache", help="Forget cached Hydrocron responses and converted shapefiles"):
+    CACHE.clear()
+    shutil.rmtree(SWORD_CACHE_DIR, ignore_errors=True)
+    load_sword.clear()
+    # Force the current upload, if any, to be converted again on this run
+    st.session_state.sword_path = None
+    st.session_state.upload_key = None
+    st.sidebar.success("Cache cleared")
+
 # --- Session State ---
-if 'geo_df' not in st.session_state:
-    st.session_state.geo_df = None
+if 'sword_path' not in st.session_state:
+    st.session_state.sword_path = None
 if 'upload_key' not in st.session_state:
     st.session_state.upload_key = None
-if 'valid_fields' not in st.session_state:
-    st.session_state.valid_fields = get_valid_api_fields()
+if 'http' not in st.session_state:
+    st.session_state.http = make_http_session()
+if 'api_fields_widget' not in st.session_state:
+    # Seeded here rather than via default= so "Select All Fields" can overwrite it
+    st.session_state.api_fields_widget = list(DEFAULT_FIELDS)
 
 # --- Upload Section ---
 st.header("Data Input")
@@ -84,42 +355,40 @@ sword_file = st.file_uploader(
 if sword_file:
     current_key = tuple((f.name, f.size) for f in sword_file)
     if current_key != st.session_state.upload_key:
-        temp_dir = safe_temp_dir()
-        for file in sword_file:
-            with open(os.path.join(temp_dir, file.name), 'wb') as out:
-                out.write(file.getbuffer())
-        shp_files = [f for f in os.listdir(temp_dir) if f.endswith('.shp')]
-        if shp_files:
+        if any(f.name.endswith('.shp') for f in sword_file):
             try:
-                df = gpd.read_file(os.path.join(temp_dir, shp_files[0]))
-                st.session_state.geo_df = df
-                st.success(f"Loaded {len(df)} river reaches")
+                path = load_sword(tuple((f.name, f.getvalue()) for f in sword_file))
+                st.session_state.sword_path = path
+                st.session_state.geo_cols = pq.read_schema(path).names
+                st.success(f"Loaded {pq.read_metadata(path).num_rows} river reaches")
                 st.session_state.upload_key = current_key
             except Exception as e:
                 st.error(f"Error loading shapefile: {e}")
         else:
             st.error("No .shp file found in upload")
-        robust_rmtree(temp_dir)
 
-if st.session_state.geo_df is not None:
+# Filter choices and the processing controls are separate fragments: changing a
+# widget only reruns its own fragment, not the upload handling or the other half.
+@st.fragment
+def filter_ui():
     st.subheader("Filter Parameters")
-    cols = st.session_state.geo_df.columns.tolist()
-    filter_column = st.selectbox("Filter By Column", options=cols, index=0)
-    distinct_vals = st.session_state.geo_df[filter_column].dropna().unique().tolist()
-    if distinct_vals:
-        filter_value = st.selectbox("Filter Value", options=distinct_vals)
-    else:
+    filter_column = st.selectbox(
+        "Filter By Column", options=st.session_state.geo_cols, index=0, key="filter_column"
+    )
+    distinct_vals = distinct_values(st.session_state.sword_path, filter_column)
+    st.selectbox("Filter Value", options=distinct_vals, key="filter_value")
+    if not distinct_vals:
         st.warning("No values in selected column")
-        filter_value = None
 
     st.subheader("Feature & Collection")
-    feature_type = st.selectbox(
+    st.selectbox(
         "Select feature type", 
         options=["Reach", "Node"],
         index=0,
-        help="Choose whether to query Reach or Node time series"
+        help="Choose whether to query Reach or Node time series",
+        key="feature_type"
     )
-    collection_name = st.selectbox(
+    st.selectbox(
         "Select collection name", 
         options=[
             # Version C/2.0
@@ -130,103 +399,150 @@ if st.session_state.geo_df is not None:
             "SWOT_L2_HR_LakeSP_D", "SWOT_L2_HR_LakeSP_prior_D"
         ],
         index=0,
-        help="Choose which SWOT collection version to query"
+        help="Choose which SWOT collection version to query",
+        key="collection_name"
     )
 
     st.subheader("Time Range")
     c1, c2 = st.columns(2)
     with c1:
-        start_date = st.date_input("Start Date", datetime(2023, 8, 1))
+        st.date_input("Start Date", datetime(2023, 8, 1), key="start_date")
     with c2:
-        end_date = st.date_input("End Date", datetime(2025, 5, 30))
+        st.date_input("End Date", datetime(2025, 5, 30), key="end_date")
 
     st.subheader("API Fields to Retrieve")
     fc, bc = st.columns([3, 1])
     with fc:
-        selected_fields = st.multiselect(
+        st.multiselect(
             "Select fields to retrieve from API",
-            st.session_state.valid_fields,
-            default=["reach_id", "time_str", "wse", "width"],
+            VALID_API_FIELDS,
             key="api_fields_widget"
         )
     with bc:
-        if st.button("Select All Fields"):
-            st.session_state.selected_fields = st.session_state.valid_fields
+        # Runs before the next rerun renders the multiselect, so the widget picks it up
+        st.button(
+            "Select All Fields",
+            on_click=lambda: st.session_state.update(api_fields_widget=list(VALID_API_FIELDS))
+        )
+
 
+@st.fragment
+def process_ui():
     throttle_delay = st.slider("Request Delay (seconds)", 0.1, 2.0, 0.5, 0.1)
+    n_workers = st.slider(
+        "Parallel Requests", 1, MAX_WORKERS, 8, 1,
+        help="Requests kept in flight at once; the request delay still caps the overall rate"
+    )
+    batch_size = st.slider(
+        "IDs per Request", 1, 50, 1, 1,
+        help="Send several comma-separated feature ids in one request. Leave at 1 unless the "
+             "Hydrocron endpoint accepts id lists; rejected batches are split until the bad id is found."
+    )
+
+    # Everything chosen in filter_ui is read back from its widget keys
+    filter_column = st.session_state.filter_column
+    filter_value = st.session_state.filter_value
+    feature_type = st.session_state.feature_type
+    collection_name = st.session_state.collection_name
+    start_date = st.session_state.start_date
+    end_date = st.session_state.end_date
+    selected_fields = st.session_state.api_fields_widget
 
     if st.button("🚀 Process Data", type="primary") and filter_value and selected_fields:
-        df_geo = st.session_state.geo_df
-        filtered = df_geo[df_geo[filter_column] == filter_value]
         ids_key = 'reach_id' if feature_type == 'Reach' else 'node_id'
-        feature_ids = filtered[ids_key].dropna().astype(str).tolist()
-        if not feature_ids:
+        path = st.session_state.sword_path
+        rows = value_index(path, filter_column)[filter_value]
+        ids = read_sword_columns(path, (ids_key,))[ids_key].iloc[rows]
+        # Ids repeat when e.g. reaches are taken from a node-level shapefile; fetch each once.
+        # SWORD ids are integers; format them in one numpy pass rather than per-element str()
+        feature_ids = ids[ids.notna()].drop_duplicates().to_numpy().astype('int64').astype('U20')
+        if len(feature_ids) == 0:
             st.warning(f"No {ids_key} values for {filter_value}")
-            st.stop()
+            return
         st.info(f"Processing {len(feature_ids)} {feature_type.lower()}s for {filter_value}")
 
-        safe_val = "".join(c for c in filter_value if c.isalnum() or c in " _-")
+        safe_val = UNSAFE_PATH_CHARS.sub("", str(filter_value))
         OUTPUT_DIR = f"swot_{safe_val}_output"
         os.makedirs(OUTPUT_DIR, exist_ok=True)
         LOG_FILE = os.path.join(OUTPUT_DIR, "logger.txt")
 
-        results = []
         errors = 0
         pbar = st.progress(0)
         status = st.empty()
+        label = feature_type.lower()
+        client = HedgedClient(st.session_state.http, RateLimiter(throttle_delay), n_workers)
+        combined_path = os.path.join(OUTPUT_DIR, f"combined_{safe_val}.parquet")
+
+        # Everything but the feature id is fixed for the run: build it once and
+        # only concatenate the id per request
+        url_prefix = f"{HYDROCRON_URL}?feature={feature_type}&feature_id="
+        fields = list(selected_fields)
+        if batch_size > 1 and ids_key not in fields:
+            # Batched responses are split back per feature on the id column
+            fields.append(ids_key)
+        url_suffix = (
+            f"&collection_name={collection_name}"
+            f"&start_time={start_date}T00:00:00Z"
+            f"&end_time={end_date}T00:00:00Z"
+            f"&output=csv&fields={','.join(fields)}"
+        )
+        batches = [list(feature_ids[i:i + batch_size]) for i in range(0, len(feature_ids), batch_size)]
 
-        for i, fid in enumerate(feature_ids):
-            pbar.progress((i+1)/len(feature_ids))
-            status.info(f"Fetching {feature_type.lower()} {fid} ({i+1}/{len(feature_ids)})...")
-            url = (
-                f"https://soto.podaac.earthdatacloud.nasa.gov/hydrocron/v1/timeseries?"
-                f"feature={feature_type}&feature_id={fid}"
-                f"&collection_name={collection_name}"
-                f"&start_time={start_date}T00:00:00Z"
-                f"&end_time={end_date}T00:00:00Z"
-                f"&output=csv&fields={','.join(selected_fields)}"
-            )
-            try:
-                resp = requests.get(url, timeout=30)
-                if resp.status_code == 429:
-                    retry = int(resp.headers.get('Retry-After', 10))
-                    status.warning(f"Rate limited, retrying in {retry}s...")
-                    time.sleep(retry)
-                    resp = requests.get(url, timeout=30)
-                if resp.status_code == 400:
-                    st.warning(f"Bad request for {feature_type.lower()} {fid}: {resp.text}")
-                    with open(LOG_FILE, "a") as logf:
-                        logf.write(f"{datetime.now().isoformat()} - {fid}\n")
-                    errors += 1
-                    continue
-                resp.raise_for_status()
-                data = resp.json()
-                csv_txt = data.get('results', {}).get('csv', '')
-                if csv_txt:
-                    df = pd.read_csv(StringIO(csv_txt))
-                    if 'time_str' in df.columns:
-                        df['time_str'] = pd.to_datetime(df['time_str'], errors='coerce')
-                        df = df.dropna(subset=['time_str'])
-                    df.to_csv(os.path.join(OUTPUT_DIR, f"{feature_type.lower()}_{fid}.csv"), index=False)
-                    results.append(df)
-                else:
-                    st.warning(f"No data for {feature_type.lower()} {fid}")
-                    errors += 1
-            except Exception as e:
-                st.error(f"Error with {feature_type.lower()} {fid}: {e}")
-                errors += 1
-            finally:
-                time.sleep(throttle_delay)
+        fetched = {}
+        bad_ids = []
+        # No `with`: leaving the block on a Streamlit stop/rerun must not wait for the queue
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        try:
+            futures = [
+                executor.submit(fetch_batch, batch, url_prefix, url_suffix, client, ids_key)
+                for batch in batches
+            ]
+            done = 0
+            for future in as_completed(futures):
+                for fid, tbl, err in future.result():
+                    done += 1
+                    fetched[fid] = tbl
+                    if err is not None:
+                        errors += 1
+                        if isinstance(err, BadRequest):
+                            st.warning(f"Bad request for {label} {fid}: {err}")
+                            bad_ids.append(f"{datetime.now().isoformat()} - {fid}\n")
+                        elif isinstance(err, NoData):
+                            st.warning(f"No data for {label} {fid}")
+                        else:
+                            st.error(f"Error with {label} {fid}: {err}")
+                pbar.progress(done/len(feature_ids))
+                status.info(f"Fetched {done}/{len(feature_ids)} {label}s...")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            client.close()
+            if bad_ids:
+                with open(LOG_FILE, "a") as logf:
+                    logf.writelines(bad_ids)
+
+        # Keep the combined output in shapefile order regardless of completion order
+        results = [fetched[fid] for fid in feature_ids if fetched.get(fid) is not None]
 
         if results:
-            combined = pd.concat(results, ignore_index=True)
-            combined_path = os.path.join(OUTPUT_DIR, f"combined_{safe_val}.csv")
-            combined.to_csv(combined_path, index=False)
-            st.success(f"Processed {len(results)} {feature_type.lower()}s with {errors} errors")
+            combined = combine_tables(results)
+            pq.write_table(combined, combined_path, compression='zstd')
+            csv_buf = BytesIO()
+            pacsv.write_csv(combined, csv_buf)
+            summary = f"Processed {len(results)} {feature_type.lower()}s with {errors} errors"
+            if client.wire_bytes:
+                summary += (
+                    f" ({client.wire_bytes / 1e6:.1f} MB transferred for {client.body_bytes / 1e6:.1f} MB "
+                    f"of responses, {client.body_bytes / client.wire_bytes:.1f}x compression)"
+                )
+            st.success(summary)
             with st.expander("Combined Data"):
                 st.dataframe(combined)
-            with open(combined_path, "rb") as f:
-                st.download_button("📅 Download Combined CSV", f, file_name=os.path.basename(combined_path))
+            st.download_button(
+                "📅 Download Combined CSV",
+                csv_buf.getvalue(),
+                file_name=f"combined_{safe_val}.csv",
+                mime="text/csv"
+            )
 
             # --- ZIP Everything ---
             zip_path = os.path.join(OUTPUT_DIR, f"{safe_val}_full_package.zip")
@@ -247,9 +563,14 @@ if st.session_state.geo_df is not None:
         else:
             st.warning("No data retrieved.")
 
-if st.session_state.geo_df is None:
+
+if st.session_state.sword_path is not None:
+    filter_ui()
+    process_ui()
+
+if st.session_state.sword_path is None:
     st.info("Upload a SWORD shapefile to start.")
-elif not st.session_state.get('selected_fields'):
+elif not st.session_state.get('api_fields_widget'):
     st.info("Select API fields and click Process Data.")
 
 